@@ -1,122 +1,118 @@
-import asyncio, json, time, hashlib, threading, websockets
-from flask import Flask, render_template, request, jsonify
+from gevent import monkey
+monkey.patch_all()
+from gevent.threadpool import ThreadPool
+import asyncio, json, os, time, threading, websockets, orjson
+from flask import Flask, Response, render_template, request, jsonify
+from flask.json.provider import JSONProvider
 from flask_socketio import SocketIO
+from chain import SATOSHI, Transaction, Blockchain, mine_prefix, tx_id
 
-class Transaction:
-    def __init__(self, sender, recipient, amount, signature=None):
-        self.sender = sender
-        self.recipient = recipient
-        self.amount = amount
-        self.signature = signature
-
-    def to_dict(self):
-        return {
-            "sender": self.sender,
-            "recipient": self.recipient,
-            "amount": self.amount,
-            "signature": self.signature
-        }
-
-    def __repr__(self):
-        return f"{self.sender}->{self.recipient}:{self.amount}"
-
-class Block:
-    def __init__(self, transactions, previous_hash):
-        self.timestamp = time.time()
-        self.transactions = transactions
-        self.previous_hash = previous_hash
-        self.nonce = 0
-        self.hash = self.calculate_hash()
-
-    def calculate_hash(self):
-        txs = [tx.to_dict() for tx in self.transactions]
-        payload = json.dumps({
-            "timestamp": self.timestamp,
-            "transactions": txs,
-            "previous_hash": self.previous_hash,
-            "nonce": self.nonce
-        }, sort_keys=True)
-        return hashlib.sha256(payload.encode()).hexdigest()
-
-    def mine_block(self, difficulty):
-        target = "0" * difficulty
-        while self.hash[:difficulty] != target:
-            self.nonce += 1
-            self.hash = self.calculate_hash()
-
-class Blockchain:
-    def __init__(self):
-        self.chain = [self.create_genesis_block()]
-        self.difficulty = 3
-        self.pending_transactions = []
-        self.mining_reward = 10.0
-
-    def create_genesis_block(self):
-        return Block([], "0")
-
-    def get_latest_block(self):
-        return self.chain[-1]
-
-    def create_transaction(self, tx: Transaction):
-        self.pending_transactions.append(tx)
-        return True
-
-    def mine_pending_transactions(self, miner_address):
-        reward_tx = Transaction("system", miner_address, f"{self.mining_reward:.8f}")
-        txs_to_mine = self.pending_transactions + [reward_tx]
-        block = Block(txs_to_mine, self.get_latest_block().hash)
-        block.mine_block(self.difficulty)
-        self.chain.append(block)
-        self.pending_transactions = []
-        return block
-
-    def get_balance(self, address):
-        if not address:
-            return 0.0
-        addr = address.lower()
-        balance = 0.0
-        for block in self.chain:
-            for tx in block.transactions:
-                try:
-                    s = (tx.sender or "").lower()
-                    r = (tx.recipient or "").lower()
-                    amt = float(tx.amount)
-                except:
-                    s = tx.sender
-                    r = tx.recipient
-                    amt = 0.0
-                if s == addr:
-                    balance -= amt
-                if r == addr:
-                    balance += amt
-        return balance
+class OrjsonProvider(JSONProvider):
+    # jsonify は orjson で処理する（キー順は標準のプロバイダと同じくソート）
+    # request.get_json() は標準の json のまま（orjson は 64bit 超の整数を float に変え、NaN/Infinity を受け付けない）
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return json.loads(s)
 
 app = Flask(__name__)
-socketio = SocketIO(app, cors_allowed_origins="*")
-blockchain = Blockchain()
+app.json = OrjsonProvider(app)
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode='gevent')
+# 署名検証は OS スレッドで行う（coincurve は GIL を解放するので、待っている間も他のリクエストを処理できる）
+# 1 コアではスレッドをまたぐ分だけ遅くなるので、その場で検証する
+cpus = os.cpu_count() or 1
+blockchain = Blockchain(verify_pool=ThreadPool(cpus) if cpus > 1 else None)
+
+# Socket.IO 通知はまとめて送る（1 回の emit に最大 EMIT_BATCH 件）
+EMIT_BATCH = 50
+pending_emits = []
+pending_emits_lock = threading.Lock()
+
+def queue_emit(event):
+    with pending_emits_lock:
+        pending_emits.append(event)
+
+def flush_emits():
+    while True:
+        with pending_emits_lock:
+            batch = pending_emits[:EMIT_BATCH]
+            del pending_emits[:EMIT_BATCH]
+        if not batch:
+            return
+        socketio.emit('updates', batch)
+        socketio.sleep(0)
+
+def is_encodable(tx):
+    # ブロックのハッシュやブロードキャストは orjson なので、エンコードできないトランザクションは受け付けない
+    # （64bit を超える整数やサロゲート単体を含む文字列が残るとマイニングが止まる）
+    if not isinstance(tx.sender, str) or not isinstance(tx.recipient, str):
+        return False
+    if tx.signature is not None and not isinstance(tx.signature, str):
+        return False
+    try:
+        orjson.dumps(tx.to_dict())
+    except (TypeError, ValueError):
+        return False
+    return True
 
 peers = set()
+peer_conns = {}
+p2p_loop = None
+p2p_loop_lock = threading.Lock()
+
+def get_p2p_loop():
+    # P2P 用のイベントループは 1 つだけ起動して使い回す
+    global p2p_loop
+    with p2p_loop_lock:
+        if p2p_loop is None:
+            p2p_loop = asyncio.new_event_loop()
+            threading.Thread(target=p2p_loop.run_forever, daemon=True).start()
+    return p2p_loop
+
+MAX_PEER_SENDS = 100
+
+async def send_to_peer(peer, payload, sem):
+    async with sem:
+        for _ in range(2):
+            # 接続処理はタスクとしてキャッシュし、同時に送る側は同じタスクを待つ（二重に接続しない）
+            conn = peer_conns.get(peer)
+            if conn is None:
+                conn = peer_conns[peer] = asyncio.ensure_future(
+                    websockets.connect(peer, open_timeout=2, close_timeout=1))
+            try:
+                ws = await asyncio.shield(conn)
+                await ws.send(payload)
+                return
+            except Exception as e:
+                if peer_conns.get(peer) is conn:
+                    del peer_conns[peer]
+                if not isinstance(e, websockets.ConnectionClosed):
+                    raise
 
 async def broadcast(message):
-    for peer in list(peers):
-        try:
-            async with websockets.connect(peer) as ws:
-                await ws.send(json.dumps(message))
-        except Exception:
-            pass
+    payload = orjson.dumps({**message, 'origin': blockchain.node_id})
+    sem = asyncio.Semaphore(MAX_PEER_SENDS)
+    await asyncio.gather(*(send_to_peer(peer, payload, sem) for peer in list(peers)), return_exceptions=True)
 
-async def p2p_server(ws, path):
+async def p2p_server(ws, path=None):
     async for raw in ws:
         try:
-            data = json.loads(raw)
+            data = orjson.loads(raw)
+            if data.get("origin") == blockchain.node_id:
+                continue
             t = data.get("type")
             if t == "new_tx":
                 txd = data.get("data", {})
+                tid = tx_id(txd.get("sender"), txd.get("recipient"), txd.get("amount"), txd.get("signature"))
+                if not blockchain.mark_seen(tid):
+                    continue
                 tx = Transaction(txd.get("sender"), txd.get("recipient"), txd.get("amount"), txd.get("signature"))
-                blockchain.create_transaction(tx)
-                socketio.emit('update', {'type': 'transaction'})
+                if is_encodable(tx) and blockchain.create_transaction(tx):
+                    queue_emit({'type': 'transaction'})
             elif t == "new_block":
-                socketio.emit('update', {'type': 'block', 'data': data.get("data")})
+                queue_emit({'type': 'block', 'data': data.get("data")})
+            flush_emits()
         except Exception as e:
             print("p2p_server error:", e)
 
@@ -125,7 +121,7 @@ async def run_p2p_server(port=6000):
     await server.wait_closed()
 
 def start_p2p_in_thread(port=6000):
-    threading.Thread(target=lambda: asyncio.run(run_p2p_server(port)), daemon=True).start()
+    asyncio.run_coroutine_threadsafe(run_p2p_server(port), get_p2p_loop())
 
 @app.route('/')
 def index():
@@ -141,14 +137,18 @@ def new_transaction():
         return 'Missing values', 400
 
     tx = Transaction(values['sender'], values['recipient'], values['amount'], values.get('signature'))
-    blockchain.create_transaction(tx)
+    if not is_encodable(tx):
+        return 'Invalid transaction', 400
+    if not blockchain.create_transaction(tx):
+        return 'Invalid signature', 400
 
     try:
-        asyncio.run(broadcast({'type': 'new_tx', 'data': tx.to_dict()}))
+        asyncio.run_coroutine_threadsafe(broadcast({'type': 'new_tx', 'data': tx.to_dict()}), get_p2p_loop())
     except:
         pass
 
-    socketio.emit('update', {'type': 'transaction'})
+    queue_emit({'type': 'transaction'})
+    flush_emits()
     return 'Transaction accepted', 201
 
 @app.route('/mine_with_chain', methods=['POST'])
@@ -156,56 +156,52 @@ def mine_with_chain():
     data = request.get_json()
     chain = data.get("chain")
 
-    if chain is None or len(chain) == 0:
+    if not isinstance(chain, list) or len(chain) == 0:
         return jsonify({"error": "chain required"}), 400
 
     last_block = chain[-1]
+    if not isinstance(last_block, dict) or not isinstance(last_block.get("index"), int) \
+            or not isinstance(last_block.get("hash"), str):
+        return jsonify({"error": "invalid last block"}), 400
     last_hash = last_block["hash"]
 
     # 新しいブロックを生成（transactions は任意で適用）
     new_block = {
         "index": last_block["index"] + 1,
         "timestamp": time.time(),
-        "transactions": pending_transactions.copy(),
-        "previous_hash": last_hash,
-        "nonce": 0
+        "transactions": [tx.to_dict() for tx in blockchain.pending_transactions],
+        "previous_hash": last_hash
     }
+    # レスポンスは orjson で返すので、エンコードできない値（64bit 超の index など）はマイニング前に弾く
+    try:
+        orjson.dumps(new_block)
+    except (TypeError, ValueError):
+        return jsonify({"error": "invalid last block"}), 400
 
-    # PoW（簡略版）
-    while True:
-        block_string = json.dumps(new_block, sort_keys=True).encode()
-        block_hash = hashlib.sha256(block_string).hexdigest()
-        if block_hash.startswith("0000"):
-            break
-        new_block["nonce"] += 1
-
-    new_block["hash"] = block_hash
+    # PoW（簡略版）: hash = sha256(json.dumps(hash を除いたブロック, sort_keys=True))
+    # nonce=0 でテンプレートを一度だけ作り、nonce の前後で分けて前半の SHA-256 状態を使い回す
+    template = json.dumps({**new_block, "nonce": 0}, sort_keys=True).encode()
+    nonce_off = template.index(b'"nonce": ') + len(b'"nonce": ')
+    new_block["nonce"], digest = mine_prefix(template[:nonce_off], 4, suffix=template[nonce_off + 1:])
+    new_block["hash"] = digest.hex()
+    response = jsonify(new_block)
 
-    # pending をリセット
-    pending_transactions.clear()
+    # pending をリセット（レスポンスを作ってから）
+    blockchain.pending_transactions.clear()
 
-    return jsonify(new_block)
+    return response
 
 @app.route('/balance/<address>')
 def balance(address):
     try:
-        amt = float(blockchain.get_balance(address))
+        amt = blockchain.get_balance(address) / SATOSHI
     except:
         amt = 0.0
     return jsonify({'balance': amt})
 
 @app.route('/chain')
 def full_chain():
-    chain_data = []
-    for block in blockchain.chain:
-        chain_data.append({
-            'timestamp': block.timestamp,
-            'transactions': [tx.to_dict() for tx in block.transactions],
-            'hash': block.hash,
-            'prev_hash': block.previous_hash,
-            'nonce': block.nonce
-        })
-    return jsonify({'length': len(chain_data), 'chain': chain_data})
+    return Response(blockchain.chain_json(), mimetype='application/json')
 
 if __name__ == '__main__':
     start_p2p_in_thread(port=6000)
@@ -0,0 +1,283 @@
+import collections, functools, hashlib, json, os, sys, time, uuid, orjson
+from concurrent.futures import ProcessPoolExecutor
+import coincurve
+from coincurve.ecdsa import cdata_to_der, der_to_cdata, deserialize_compact, signature_normalize
+
+SATOSHI = 10**8
+SEEN_TX_MAX = 10000
+VERIFY_CACHE_MAX = 4096
+# os.cpu_count() は判定できないと None を返す
+CPUS = os.cpu_count() or 1
+
+def tx_id(sender, recipient, amount, signature):
+    # 区切り文字の連結だとフィールドをまたいで同じ ID が作れるので、JSON 配列にしてから要約する
+    payload = json.dumps([sender, recipient, amount, signature])
+    return hashlib.blake2b(payload.encode(), digest_size=16).digest()
+
+class Transaction:
+    __slots__ = ("sender", "recipient", "amount", "signature", "amount_sat", "_sig_bytes", "_pub_bytes")
+
+    def __init__(self, sender, recipient, amount, signature=None):
+        # アドレスは生成時に一度だけ小文字化・intern しておく
+        self.sender = sys.intern(sender.lower()) if isinstance(sender, str) else sender
+        self.recipient = sys.intern(recipient.lower()) if isinstance(recipient, str) else recipient
+        self.amount = amount
+        self.signature = signature
+        # 残高計算用に整数（1e-8 単位）で保持。amount は署名・送信用にそのまま残す
+        try:
+            self.amount_sat = int(round(float(amount) * SATOSHI))
+        except (TypeError, ValueError, OverflowError):
+            self.amount_sat = 0
+        # 署名と公開鍵の16進デコードは受信時に一度だけ行う（不正な署名は b"" にして検証で弾く）
+        try:
+            self._sig_bytes = bytes.fromhex(signature) if signature else None
+        except (TypeError, ValueError):
+            self._sig_bytes = b""
+        try:
+            pub = bytes.fromhex(self.sender)
+            self._pub_bytes = b"\x04" + pub if len(pub) == 64 else pub
+        except (TypeError, ValueError):
+            self._pub_bytes = None
+
+    def message(self):
+        return f"{self.sender}->{self.recipient}:{self.amount}".encode()
+
+    def to_dict(self):
+        return {
+            "sender": self.sender,
+            "recipient": self.recipient,
+            "amount": self.amount,
+            "signature": self.signature
+        }
+
+    def __repr__(self):
+        return f"{self.sender}->{self.recipient}:{self.amount}"
+
+@functools.lru_cache(maxsize=4096)
+def _get_pubkey(pub_bytes):
+    return coincurve.PublicKey(pub_bytes)
+
+def _verify_signature(pub_bytes, sig_bytes, msg):
+    if not pub_bytes or not sig_bytes:
+        return False
+    try:
+        vk = _get_pubkey(pub_bytes)
+        raw = deserialize_compact(sig_bytes) if len(sig_bytes) == 64 else der_to_cdata(sig_bytes)
+        # libsecp256k1 は low-S のみ受け付けるので正規化してから検証
+        _, raw = signature_normalize(raw)
+        return vk.verify(cdata_to_der(raw), msg)
+    except (ValueError, TypeError):
+        return False
+
+def _verify_one(item):
+    pub_bytes, sig_bytes, msg = item
+    if sig_bytes is None:
+        return True
+    return _verify_signature(pub_bytes, sig_bytes, msg)
+
+# 少数なら直列の方が速いので、まとまった件数のときだけプロセスプールに投げる
+VERIFY_BATCH_MIN = 64
+verify_executor = ProcessPoolExecutor(max_workers=CPUS)
+
+def verify_block(txs, cache=None):
+    # 署名なしはそのまま通し、cache（tx_id -> 検証結果）に載っているものは検証し直さない
+    items = []
+    for tx in txs:
+        if tx._sig_bytes is None:
+            continue
+        try:
+            if cache is not None:
+                hit = cache.get(tx_id(tx.sender, tx.recipient, tx.amount, tx.signature))
+                if hit is not None:
+                    if not hit:
+                        return False
+                    continue
+            msg = tx.message()
+        except UnicodeEncodeError:
+            # UTF-8 にできない（サロゲート単体を含む）ものは不正なトランザクション扱い
+            return False
+        items.append((tx._pub_bytes, tx._sig_bytes, msg))
+    if len(items) < VERIFY_BATCH_MIN:
+        return all(map(_verify_one, items))
+    return all(verify_executor.map(_verify_one, items, chunksize=64))
+
+def pow_target(difficulty):
+    # ダイジェストを 256bit の整数とみなし、これ未満なら先頭 difficulty ニブルが 0
+    # （difficulty 0 は 33 バイトの上限にして、どの 32 バイトのダイジェストも通す）
+    if difficulty <= 0:
+        return b"\xff" * 33
+    return (1 << (256 - 4 * difficulty)).to_bytes(32, "big")
+
+def search_nonce(prefix, difficulty, start, stop, step=1, suffix=b"}"):
+    # ハッシュ対象は prefix + nonce の10進表記 + suffix
+    target = pow_target(difficulty)
+    base = hashlib.sha256(prefix)
+    for nonce in range(start, stop, step):
+        h = base.copy()
+        h.update(b"%d%b" % (nonce, suffix))
+        digest = h.digest()
+        if digest < target:
+            return nonce, digest
+    return None
+
+def mine_prefix(prefix, difficulty, start=0, suffix=b"}"):
+    window = 1 << 12
+    while True:
+        found = search_nonce(prefix, difficulty, start, start + window, 1, suffix)
+        if found:
+            return found
+        start += window
+        window = min(window * 2, 1 << 20)
+
+# これ未満の難易度は直列の方が速い（プロセス間のやり取りの方が重い）
+PARALLEL_MINING_DIFFICULTY = 5
+mining_executor = ProcessPoolExecutor(max_workers=CPUS)
+
+class Block:
+    __slots__ = ("timestamp", "transactions", "previous_hash", "nonce", "hash", "_prefix")
+
+    def __init__(self, transactions, previous_hash):
+        self.timestamp = time.time()
+        self.transactions = transactions
+        self.previous_hash = previous_hash
+        self.nonce = 0
+        # nonce 以外は変わらないので、JSON のプレフィックスは一度だけ作る
+        self._prefix = self.hash_prefix()
+        self.hash = self.calculate_hash()
+
+    def to_dict(self):
+        return {
+            'timestamp': self.timestamp,
+            'transactions': [tx.to_dict() for tx in self.transactions],
+            'hash': self.hash,
+            'prev_hash': self.previous_hash,
+            'nonce': self.nonce
+        }
+
+    def hash_prefix(self):
+        txs = [tx.to_dict() for tx in self.transactions]
+        body = orjson.dumps({
+            "timestamp": self.timestamp,
+            "transactions": txs,
+            "previous_hash": self.previous_hash
+        }, option=orjson.OPT_SORT_KEYS)
+        # nonce を末尾に置き、マイニング中はここまでの SHA-256 状態を使い回す
+        return body[:-1] + b',"nonce":'
+
+    def calculate_hash(self):
+        payload = self._prefix + f"{self.nonce}}}".encode()
+        return hashlib.sha256(payload).hexdigest()
+
+    def mine_block(self, difficulty):
+        self.nonce, digest = mine_prefix(self._prefix, difficulty, self.nonce)
+        self.hash = digest.hex()
+
+    def mine_block_parallel(self, difficulty, workers=CPUS):
+        # ワーカー i は nonce ≡ start + i (mod workers) を担当し、ラウンドごとに最小の当たりを採用
+        start, span = self.nonce, 1 << 16
+        while True:
+            stop = start + span * workers
+            futures = [mining_executor.submit(search_nonce, self._prefix, difficulty, start + i, stop, workers)
+                       for i in range(workers)]
+            found = [r for r in (f.result() for f in futures) if r]
+            if found:
+                break
+            start = stop
+        self.nonce, digest = min(found)
+        self.hash = digest.hex()
+
+class Blockchain:
+    def __init__(self, verify_pool=None):
+        self.chain = [self.create_genesis_block()]
+        self.difficulty = 3
+        self.pending_transactions = []
+        self.mining_reward = 10.0
+        self.balances = collections.defaultdict(int)
+        self.apply_block(self.chain[0])
+        # /chain のレスポンス（JSON バイト列）。新しいブロックが追加されたら破棄する
+        self._chain_cache = None
+        # ブロックごとの JSON。ブロックは不変なので追加分だけ作ればよい
+        self._block_json = []
+        # P2P で受信済みのトランザクション ID（古いものから捨てる LRU）
+        self.seen_tx_ids = collections.OrderedDict()
+        # 検証結果の LRU（キーは内容全体の ID なので、宛先や金額を差し替えたものには当たらない）
+        self._verify_cache = collections.OrderedDict()
+        # 署名検証を投げるプール（apply(func, args) を持つもの）。None ならその場で検証する
+        self._verify_pool = verify_pool
+        # 自ノードが送ったメッセージが戻ってきたときに見分けるための ID
+        self.node_id = uuid.uuid4().hex
+
+    def create_genesis_block(self):
+        return Block([], "0")
+
+    def get_latest_block(self):
+        return self.chain[-1]
+
+    def verify_transaction(self, tx: Transaction):
+        key = tx_id(tx.sender, tx.recipient, tx.amount, tx.signature)
+        hit = self._verify_cache.get(key)
+        if hit is not None:
+            self._verify_cache.move_to_end(key)
+            return hit
+        args = (tx._pub_bytes, tx._sig_bytes, tx.message())
+        if self._verify_pool is None:
+            ok = _verify_signature(*args)
+        else:
+            ok = self._verify_pool.apply(_verify_signature, args)
+        self._verify_cache[key] = ok
+        if len(self._verify_cache) > VERIFY_CACHE_MAX:
+            self._verify_cache.popitem(last=False)
+        return ok
+
+    def mark_seen(self, tid):
+        if tid in self.seen_tx_ids:
+            self.seen_tx_ids.move_to_end(tid)
+            return False
+        self.seen_tx_ids[tid] = None
+        if len(self.seen_tx_ids) > SEEN_TX_MAX:
+            self.seen_tx_ids.popitem(last=False)
+        return True
+
+    def create_transaction(self, tx: Transaction):
+        if tx.signature and not self.verify_transaction(tx):
+            return False
+        self.pending_transactions.append(tx)
+        return True
+
+    def mine_pending_transactions(self, miner_address):
+        if not verify_block(self.pending_transactions, self._verify_cache):
+            return None
+        reward_tx = Transaction("system", miner_address, f"{self.mining_reward:.8f}")
+        txs_to_mine = self.pending_transactions + [reward_tx]
+        try:
+            block = Block(txs_to_mine, self.get_latest_block().hash)
+        except (TypeError, ValueError):
+            # ハッシュ用にエンコードできないトランザクションが混ざっている
+            return None
+        if self.difficulty >= PARALLEL_MINING_DIFFICULTY:
+            block.mine_block_parallel(self.difficulty)
+        else:
+            block.mine_block(self.difficulty)
+        self.chain.append(block)
+        self.apply_block(block)
+        self._chain_cache = None
+        self.pending_transactions = []
+        return block
+
+    def chain_json(self):
+        if self._chain_cache is None:
+            blobs = self._block_json
+            for block in self.chain[len(blobs):]:
+                blobs.append(orjson.dumps(block.to_dict()))
+            self._chain_cache = b'{"length":%d,"chain":[%b]}' % (len(blobs), b",".join(blobs))
+        return self._chain_cache
+
+    def apply_block(self, block):
+        for tx in block.transactions:
+            self.balances[tx.sender] -= tx.amount_sat
+            self.balances[tx.recipient] += tx.amount_sat
+
+    def get_balance(self, address):
+        if not address:
+            return 0
+        return self.balances.get(address.lower(), 0)
@@ -0,0 +1,6 @@
+# gunicorn 用のエントリポイント
+#   gunicorn -k geventwebsocket.gunicorn.workers.GeventWebSocketWorker -w 1 -b 0.0.0.0:5000 wsgi:app
+# チェーン・未承認トランザクション・P2P 接続はプロセス内のメモリにあるので、ワーカーは 1 つにすること
+from app import app, start_p2p_in_thread
+
+start_p2p_in_thread(port=6000)